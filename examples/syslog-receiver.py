@@ -1,12 +1,15 @@
 import logging
+import queue
 import re
+import socket
+import time
 from abc import abstractmethod, ABC
 from datetime import datetime
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 from logging_journald import JournaldTransport
 
-from aiomisc import entrypoint, threaded
+from aiomisc import entrypoint
 from aiomisc.service.udp import UDPServer
 from aiomisc.service.sdwatchdog import SDWatchdogService
 
@@ -17,26 +20,115 @@ It also demonstrates how to create a NetConsole server that forwards messages to
 """
 
 
+# We have a more different syslog message formats, but this is the most common one.
+SYSLOG_PATTERN = re.compile(
+    r'^<(?P<syslog_priority>\d+)>(?P<syslog_timestamp>\w{3} +\d+ \d+:\d+:\d+) (?P<syslog_hostname>\S+) '
+    r'(?:(?P<syslog_process>[^:\[]+)\[(?P<syslog_pid>\d+)\]: |(?P<syslog_applicaton>[^:]+): )?(?P<message>.*)',
+    re.ASCII,
+)
+
+
+def _isdigits(value: str) -> bool:
+    # str.isdigit() also accepts digits like "²", the pattern matches only ASCII ones
+    return value.isascii() and value.isdigit()
+
+
+def _parse_rfc3164(message: str) -> Optional[Dict[str, str]]:
+    """
+    Linear scan for the same layout as SYSLOG_PATTERN:
+    ``<pri>Mmm dd hh:mm:ss hostname [tag: ]message``, where the tag is either
+    ``process[pid]`` or an application name, and splits it the same way the pattern does.
+    Returns None when the message doesn't fit, so the caller can fall back to the regex.
+    """
+    if not message.startswith('<'):
+        return None
+
+    pri_end = message.find('>', 1, 5)
+    if pri_end < 0 or not _isdigits(message[1:pri_end]):
+        return None
+
+    offset = pri_end + 1
+    timestamp = message[offset:offset + 15]
+    if (
+        len(timestamp) != 15 or message[offset + 15:offset + 16] != ' ' or
+        not (timestamp[:3].isascii() and timestamp[:3].isalpha()) or
+        timestamp[3] != ' ' or timestamp[6] != ' ' or
+        not (timestamp[4] == ' ' or _isdigits(timestamp[4])) or not _isdigits(timestamp[5]) or
+        timestamp[9] != ':' or timestamp[12] != ':' or
+        not _isdigits(timestamp[7:9] + timestamp[10:12] + timestamp[13:15])
+    ):
+        return None
+
+    offset += 16
+    hostname_end = message.find(' ', offset)
+    if hostname_end <= offset or len(message[offset:hostname_end].split()) != 1:
+        return None
+
+    result = {
+        'syslog_priority': message[1:pri_end],
+        'syslog_timestamp': timestamp,
+        'syslog_hostname': message[offset:hostname_end],
+    }
+
+    offset = hostname_end + 1
+    colon = message.find(':', offset)
+    if colon > offset and message[colon + 1:colon + 2] == ' ':
+        tag = message[offset:colon]
+        bracket = tag.find('[')
+        if bracket > 0 and tag[-1] == ']' and _isdigits(tag[bracket + 1:-1]):
+            result['syslog_process'] = tag[:bracket]
+            result['syslog_pid'] = tag[bracket + 1:-1]
+        else:
+            result['syslog_applicaton'] = tag
+        offset = colon + 2
+
+    result['message'] = message[offset:]
+    return result
+
+
 class JournaldTransportService(UDPServer, ABC):
     transport: JournaldTransport
+    dropped: int = 0
 
-    @threaded
     def send_log(self, **kwargs):
-        self.transport.send(kwargs.items())
+        # Runs in the event loop, so it must not wait for a stalled journald,
+        # otherwise the watchdog heartbeats stop too. Syslog over UDP is lossy
+        # anyway, so when the transport's queue is full the record is dropped.
+        try:
+            self.transport.send(kwargs.items(), block=False)
+        except queue.Full:
+            if not self.dropped:
+                logging.warning('Journald queue is full, dropping messages')
+            self.dropped += 1
+            return
+
+        if self.dropped:
+            logging.warning('Dropped %d messages while the journald queue was full', self.dropped)
+            self.dropped = 0
 
     @abstractmethod
-    async def parse_message(self, message) -> Dict[str, Any]:
+    def parse_message(self, message) -> Dict[str, Any]:
         pass
 
     async def handle_datagram(self, data, addr):
         message = data.decode()
         parsed_message = {'message': message, 'hostname': addr[0]}
-        parsed_message.update(await self.parse_message(message))
-        await self.send_log(**parsed_message)
+        parsed_message.update(self.parse_message(message))
+        self.send_log(**parsed_message)
+
+    # The default receive buffer is too small for bursts of datagrams,
+    # the kernel silently caps this value by net.core.rmem_max.
+    RECEIVE_BUFFER_SIZE = 12 * 1024 * 1024
 
     async def start(self) -> None:
         self.transport = JournaldTransport()
+        # The socket is created by super().start()
         await super().start()
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECEIVE_BUFFER_SIZE)
+
+    async def stop(self, exception: Optional[Exception] = None) -> None:
+        await super().stop(exception)
+        self.transport.close()
 
 
 class SyslogService(JournaldTransportService):
@@ -45,30 +137,38 @@ class SyslogService(JournaldTransportService):
     This is an implementation of a syslog server, which forwards messages to journald.
     """
 
-    # We have a more different syslog message formats, but this is the most common one.
-    SYSLOG_PATTERN = re.compile(
-        r'^<(?P<syslog_priority>\d+)>(?P<syslog_timestamp>\w{3} +\d+ \d+:\d+:\d+) (?P<syslog_hostname>\S+) '
-        r'((?P<syslog_applicaton>[^:]+): )?((?P<syslog_process>[^\[]+)\[(?P<syslog_pid>\d+)\]:\s+?)?(?P<message>.*)'
-    )
+    # The current year is cached for a minute, it's needed for every message
+    # because the most common timestamp format doesn't contain it.
+    YEAR_CACHE_TTL = 60
+    _year: int = 0
+    _year_expires_at: float = 0.
 
-    @staticmethod
-    def parse_timestamp(timestamp):
-        now = datetime.now()
+    def current_year(self) -> int:
+        now = time.monotonic()
+        if now >= self._year_expires_at:
+            self._year = datetime.now().year
+            self._year_expires_at = now + self.YEAR_CACHE_TTL
+        return self._year
+
+    def parse_timestamp(self, timestamp):
         try:
-            try:
-                return datetime.strptime(timestamp, '%b %d %H:%M:%S').replace(year=now.year)
-            except ValueError:
-                return datetime.strptime(timestamp, '%b %d %Y %H:%M:%S')
+            # "Mmm dd hh:mm:ss" has three space-separated parts, "Mmm dd yyyy hh:mm:ss" has four.
+            # The day may be padded with a space or not padded at all.
+            if len(timestamp.split()) == 3:
+                return datetime.strptime(timestamp, '%b %d %H:%M:%S').replace(year=self.current_year())
+            return datetime.strptime(timestamp, '%b %d %Y %H:%M:%S')
         except ValueError:
-            return now
+            return datetime.now()
 
-    @threaded
     def parse_message(self, message):
-        match = self.SYSLOG_PATTERN.match(message)
+        parsed = _parse_rfc3164(message)
+        if parsed is None:
+            match = SYSLOG_PATTERN.match(message)
+            parsed = match.groupdict() if match else None
+
         result = {'syslog_raw': message, 'message': message}
-        if match:
+        if parsed:
             try:
-                parsed = match.groupdict()
                 for key, value in parsed.items():
                     if value is not None:
                         result[key] = value
@@ -89,7 +189,7 @@ class SyslogService(JournaldTransportService):
 class NetConsoleService(JournaldTransportService):
     """ NetConsole is a simple protocol that sends messages from the kernel to a remote host. """
 
-    async def parse_message(self, message):
+    def parse_message(self, message):
         """ Nothing to parse, just forward the message. """
         result = {'priority': 6, 'message': message}
         return result
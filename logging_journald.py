@@ -1,18 +1,20 @@
 import array
 import fcntl
+import hashlib
 import logging
 import os
+import queue
 import socket
 import struct
 import sys
 import tempfile
+import threading
 import traceback
-import uuid
+import weakref
 from enum import IntEnum, unique
-from io import BytesIO
 from pathlib import Path
 from types import MappingProxyType
-from typing import IO, Any, Iterable, List, Optional, Tuple, Union
+from typing import IO, Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 
 @unique
@@ -43,93 +45,377 @@ class Facility(IntEnum):
     LOCAL7 = 23
 
 
+# Cache of uppercased and encoded field names, the limit protects
+# against unbounded growth when the keys are generated dynamically
+_KEY_BYTES: Dict[str, bytes] = {}
+_KEY_BYTES_MAX_SIZE = 1024
+
+
+def _key_bytes(key: str) -> bytes:
+    """ Returns journald field name for the key """
+    result = _KEY_BYTES.get(key)
+    if result is None:
+        result = key.upper().encode()
+        if len(_KEY_BYTES) < _KEY_BYTES_MAX_SIZE:
+            _KEY_BYTES[key] = result
+    return result
+
+
+_VALUE_LEN_STRUCT = struct.Struct("@Q")
+
+
+def _encode_short(key: str, value: bytes) -> bytes:
+    return _key_bytes(key) + b"=" + value + b"\n"
+
+
+def _encode_long(key: str, value: bytes) -> bytes:
+    length = _VALUE_LEN_STRUCT.pack(len(value))
+    return _key_bytes(key) + b"\n" + length + value + b"\n"
+
+
+def _pack(chunks: List[bytes], key: str, value: Any) -> None:
+    _PACKERS.get(type(value), _pack_fallback)(chunks, key, value)
+
+
+def _pack_none(chunks: List[bytes], key: str, value: None) -> None:
+    return
+
+
+def _pack_str(chunks: List[bytes], key: str, value: str) -> None:
+    if "\n" in value:
+        chunks.append(_encode_long(key, value.encode()))
+        return
+    chunks.append(_encode_short(key, value.encode()))
+
+
+def _pack_int(chunks: List[bytes], key: str, value: int) -> None:
+    chunks.append(_encode_short(key, b"%d" % value))
+
+
+def _pack_number(chunks: List[bytes], key: str, value: Union[int, float]) -> None:
+    chunks.append(_encode_short(key, str(value).encode("ascii")))
+
+
+def _pack_bytes(chunks: List[bytes], key: str, value: bytes) -> None:
+    chunks.append(_encode_long(key, value))
+
+
+def _pack_sequence(chunks: List[bytes], key: str, value: Union[List[Any], Tuple[Any, ...]]) -> None:
+    for idx, item in enumerate(value):
+        _pack(chunks, "{}_{}".format(key, idx), item)
+
+
+def _pack_dict(chunks: List[bytes], key: str, value: Dict[Any, Any]) -> None:
+    for d_key, d_value in value.items():
+        _pack(chunks, "{}_{}".format(key, d_key), d_value)
+
+
+def _pack_fallback(chunks: List[bytes], key: str, value: Any) -> None:
+    # Subclasses of the supported types are rare, so they aren't in
+    # the _PACKERS table and are dispatched here instead
+    if isinstance(value, int):
+        _pack_int(chunks, key, value)
+    elif isinstance(value, float):
+        _pack_number(chunks, key, value)
+    elif isinstance(value, str):
+        _pack_str(chunks, key, value)
+    elif isinstance(value, bytes):
+        _pack_bytes(chunks, key, value)
+    elif isinstance(value, (list, tuple)):
+        _pack_sequence(chunks, key, value)
+    elif isinstance(value, dict):
+        _pack_dict(chunks, key, value)
+    else:
+        _pack_bytes(chunks, key, str(value).encode())
+
+
+# Exact type lookup is cheaper than the chain of isinstance checks
+_PACKERS: Dict[type, Callable[[List[bytes], str, Any], None]] = {
+    str: _pack_str,
+    int: _pack_int,
+    float: _pack_number,
+    bool: _pack_number,
+    type(None): _pack_none,
+    bytes: _pack_bytes,
+    list: _pack_sequence,
+    tuple: _pack_sequence,
+    dict: _pack_dict,
+}
+
+
+# Python doesn't expose sendmmsg(2), so it's called through ctypes where libc has it.
+# It writes a batch of datagrams with a single syscall and returns how many were sent.
+_sendmmsg: Optional[Callable[[int, Sequence[bytes]], int]] = None
+
+try:
+    import ctypes
+
+    _libc_sendmmsg = getattr(ctypes.CDLL(None), "sendmmsg", None)
+except (ImportError, OSError):  # pragma: no cover
+    _libc_sendmmsg = None
+
+if _libc_sendmmsg is not None:
+    class _IOVec(ctypes.Structure):
+        _fields_ = [
+            ("iov_base", ctypes.c_void_p),
+            ("iov_len", ctypes.c_size_t),
+        ]
+
+    class _MsgHdr(ctypes.Structure):
+        _fields_ = [
+            ("msg_name", ctypes.c_void_p),
+            ("msg_namelen", ctypes.c_uint32),
+            ("msg_iov", ctypes.POINTER(_IOVec)),
+            ("msg_iovlen", ctypes.c_size_t),
+            ("msg_control", ctypes.c_void_p),
+            ("msg_controllen", ctypes.c_size_t),
+            ("msg_flags", ctypes.c_int),
+        ]
+
+    class _MMsgHdr(ctypes.Structure):
+        _fields_ = [
+            ("msg_hdr", _MsgHdr),
+            ("msg_len", ctypes.c_uint),
+        ]
+
+    _libc_sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    _libc_sendmmsg.restype = ctypes.c_int
+
+    # The closure below doesn't see the "is not None" narrowing of the module name
+    libc_sendmmsg: Callable[..., int] = _libc_sendmmsg
+
+    def _sendmmsg_ctypes(fd: int, payloads: Sequence[bytes]) -> int:
+        count = len(payloads)
+        iovecs = (_IOVec * count)()
+        messages = (_MMsgHdr * count)()
+        for idx, payload in enumerate(payloads):
+            # Points to the bytes object's own buffer, payloads keep it alive
+            iovecs[idx].iov_base = ctypes.cast(ctypes.c_char_p(payload), ctypes.c_void_p)
+            iovecs[idx].iov_len = len(payload)
+            messages[idx].msg_hdr.msg_iov = ctypes.pointer(iovecs[idx])
+            messages[idx].msg_hdr.msg_iovlen = 1
+        return libc_sendmmsg(fd, messages, count, 0)
+
+    _sendmmsg = _sendmmsg_ctypes
+
+
+# Encoded record with its error context, flush marker or the stop marker
+_QueueItemType = Union[Tuple[bytes, Any], threading.Event, None]
+ErrorCallbackType = Callable[[Any, Exception], None]
+
+
 class JournaldTransport:
-    VALUE_LEN_STRUCT = struct.Struct("@Q")
+    VALUE_LEN_STRUCT = _VALUE_LEN_STRUCT
     SOCKET_PATH = Path("/run/systemd/journal/socket")
 
-    def __init__(self, socket_path: Union[str, Path] = SOCKET_PATH):
+    # Datagrams bigger than the send buffer are passed through memfd, which
+    # costs a few extra syscalls. The kernel caps this by net.core.wmem_max.
+    SEND_BUFFER_SIZE = 8 << 20
+
+    # Maximum amount of records the sender thread takes from the queue at once
+    BATCH_SIZE = 64
+
+    # Maximum amount of records waiting to be written. When the queue is full
+    # enqueue() blocks until the sender thread catches up, so a stalled journald
+    # slows the callers down like a blocking write would, nothing is dropped.
+    # Callers which must not block pass block=False and handle queue.Full.
+    QUEUE_SIZE = 1024
+
+    def __init__(
+        self, socket_path: Union[str, Path] = SOCKET_PATH,
+        error_callback: Optional[ErrorCallbackType] = None,
+    ):
+        """
+        error_callback is called from the sender thread with the context
+        passed to send() and the exception when the record can't be written.
+        """
         self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
         self.socket.connect(str(self.SOCKET_PATH))
+        self.socket.setsockopt(
+            socket.SOL_SOCKET, socket.SO_SNDBUF, self.SEND_BUFFER_SIZE,
+        )
+
+        self.error_callback = error_callback
+        self._closed = threading.Event()
+        self._start_sender()
+        _TRANSPORTS.add(self)
+
+    def _start_sender(self) -> None:
+        if self._closed.is_set():
+            return
+        self._queue: "queue.Queue[_QueueItemType]" = queue.Queue(self.QUEUE_SIZE)
+        # The thread holds only a weak reference, so a transport which was never
+        # closed is still garbage collected, then the thread is told to stop.
+        self._thread = threading.Thread(
+            target=_sender, args=(weakref.ref(self), self._queue),
+            name="journald-transport", daemon=True,
+        )
+        weakref.finalize(self, _stop_sender, self._queue)
+        self._thread.start()
 
     if hasattr(os, "memfd_create"):
+        MEMFD_SEALS = (
+            fcntl.F_SEAL_SHRINK | fcntl.F_SEAL_GROW |
+            fcntl.F_SEAL_WRITE | fcntl.F_SEAL_SEAL
+        )
+
         @staticmethod
         def memfd_open(*args: Any, **kwargs: Any) -> IO[bytes]:
             """ Return memfd file-like object """
-            fd: int = os.memfd_create(
-                tempfile.mktemp(), os.MFD_ALLOW_SEALING,
-            )
+            # The name is only shown in /proc/<pid>/fd, it doesn't have to be unique
+            fd: int = os.memfd_create("journald", os.MFD_ALLOW_SEALING)
             return os.fdopen(fd, *args, **kwargs)
 
-        @staticmethod
-        def memfd_seal(fp: IO[bytes]) -> None:
+        @classmethod
+        def memfd_seal(cls, fp: IO[bytes]) -> None:
             fp.flush()
-            fcntl.fcntl(
-                fp.fileno(),
-                fcntl.F_ADD_SEALS,
-                fcntl.F_SEAL_SHRINK | fcntl.F_SEAL_GROW |
-                fcntl.F_SEAL_WRITE | fcntl.F_SEAL_SEAL,
-            )
+            fcntl.fcntl(fp.fileno(), fcntl.F_ADD_SEALS, cls.MEMFD_SEALS)
     else:
         @staticmethod
         def memfd_open(*args: Any, **kwargs: Any) -> IO[bytes]:
             """ Return python temporary file object """
             return tempfile.TemporaryFile(*args, **kwargs)
 
-        @staticmethod
-        def memfd_seal(fp: IO[bytes]) -> None:
+        @classmethod
+        def memfd_seal(cls, fp: IO[bytes]) -> None:
             pass
 
     @staticmethod
-    def _encode_short(key: str, value: Any) -> bytes:
-        return "{}={}\n".format(key.upper(), value).encode()
+    def pack(chunks: List[bytes], key: str, value: Any) -> None:
+        _pack(chunks, key, value)
+
+    def _write_batch(self, item: _QueueItemType) -> bool:
+        """
+        Writes the item and whatever else is already queued,
+        returns False when the stop marker is reached.
+        """
+        batch = [item]
+        while len(batch) < self.BATCH_SIZE:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        records: List[Tuple[bytes, Any]] = []
+        for item in batch:
+            if isinstance(item, tuple):
+                records.append(item)
+                continue
 
-    @classmethod
-    def _encode_long(cls, key: str, value: bytes) -> bytes:
-        length = cls.VALUE_LEN_STRUCT.pack(len(value))
-        return key.upper().encode() + b"\n" + length + value + b"\n"
+            # Markers are handled only when everything enqueued before is written
+            self._submit_records(records)
+            records = []
 
-    @classmethod
-    def pack(cls, fp: IO[bytes], key: str, value: Any) -> None:
-        if value is None:
-            return
-        elif isinstance(value, (int, float)):
-            fp.write(cls._encode_short(key, value))
-            return
-        elif isinstance(value, str):
-            if "\n" in value:
-                fp.write(cls._encode_long(key, value.encode()))
-                return
-            fp.write(cls._encode_short(key, value))
-            return
-        elif isinstance(value, bytes):
-            fp.write(cls._encode_long(key, value))
-            return
-        elif isinstance(value, (list, tuple)):
-            for idx, item in enumerate(value):
-                cls.pack(fp, "{}_{}".format(key, idx), item)
-            return
-        elif isinstance(value, dict):
-            for d_key, d_value in value.items():
-                cls.pack(fp, "{}_{}".format(key, d_key), d_value)
-            return
+            if item is None:
+                return False
+            item.set()
 
-        cls.pack(fp, key, str(value).encode())
-        return
+        self._submit_records(records)
+        return True
 
-    def send(self, pairs: Iterable[Tuple[str, Any]]) -> None:
-        with BytesIO() as fp:
-            for key, value in pairs:
-                self.pack(fp, key, value)
-            value = fp.getvalue()
+    def _submit_records(self, records: Sequence[Tuple[bytes, Any]]) -> None:
+        # The markers must be handled whatever happens here, otherwise
+        # flush() would wait forever.
+        try:
+            self.submit_many(records)
+        except Exception:
+            pass
+
+    def submit_many(self, records: Sequence[Tuple[bytes, Any]]) -> None:
+        """
+        Write the encoded records, given as (payload, context) pairs, to the
+        socket using as few sendmmsg(2) calls as possible. Errors are reported
+        through error_callback for each record separately.
+        """
+        payloads = [payload for payload, _ in records]
+        idx = 0
+        while idx < len(payloads):
+            sent = 0
+            if _sendmmsg is not None and len(payloads) - idx > 1:
+                sent = _sendmmsg(self.socket.fileno(), payloads[idx:])
+
+            if sent > 0:
+                idx += sent
+                continue
 
+            # sendmmsg is not available or failed on the first record,
+            # submit() either writes it via memfd or raises the error.
+            try:
+                self.submit(payloads[idx])
+            except Exception as e:
+                self._handle_error(records[idx][1], e)
+            idx += 1
+
+    def _handle_error(self, context: Any, exc: Exception) -> None:
+        # Called from the sender thread, so it must never raise
+        if self.error_callback is not None:
+            try:
+                self.error_callback(context, exc)
+                return
+            except Exception as e:
+                exc = e
+
+        try:
+            sys.stderr.write(
+                "Unable to write message to journald: {!r}\n".format(exc),
+            )
+        except Exception:
+            pass
+
+    @classmethod
+    def encode(cls, pairs: Iterable[Tuple[str, Any]], prefix: bytes = b"") -> bytes:
+        """
+        Returns the record encoded with journald native protocol,
+        prefix is the already encoded fields to prepend.
+        """
+        chunks: List[bytes] = [prefix]
+        for key, value in pairs:
+            cls.pack(chunks, key, value)
+        return b"".join(chunks)
+
+    def enqueue(self, payload: bytes, context: Any = None, block: bool = True) -> None:
+        """
+        Enqueue the encoded record, it will be written by the sender thread.
+        Blocks while QUEUE_SIZE records are already waiting, or raises
+        queue.Full when block is False. context is passed to error_callback
+        if the record can't be written.
+        """
+        if self._closed.is_set():
+            raise RuntimeError("Transport is closed")
+        self._queue.put((payload, context), block)
+
+    def send(
+        self, pairs: Iterable[Tuple[str, Any]], prefix: bytes = b"",
+        context: Any = None, block: bool = True,
+    ) -> None:
+        """ Encode the record in the calling thread and enqueue it """
+        self.enqueue(self.encode(pairs, prefix), context, block)
+
+    def flush(self) -> None:
+        """ Wait until all records enqueued before this call are written """
+        if not self._thread.is_alive():
+            return
+        event = threading.Event()
+        self._queue.put(event)
+        event.wait()
+
+    def close(self) -> None:
+        self._closed.set()
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self.socket.close()
+
+    def submit(self, payload: bytes) -> None:
+        """ Write the encoded record to the socket, blocks the calling thread """
         # noinspection PyBroadException
         try:
-            self.socket.sendall(value)
+            self.socket.sendall(payload)
         except OSError:
             # the systemd standard way to handle long payloads
             with self.memfd_open("wb+") as mfp:
                 # copy content to memfd
-                mfp.write(value)
+                mfp.write(payload)
 
                 self.memfd_seal(mfp)
                 self.socket.sendmsg(
@@ -137,6 +423,50 @@ class JournaldTransport:
                 )
 
 
+# Transports whose sender threads have to be restarted in a forked child
+_TRANSPORTS: "weakref.WeakSet[JournaldTransport]" = weakref.WeakSet()
+
+
+def _sender(
+    transport_ref: "weakref.ReferenceType[JournaldTransport]",
+    items: "queue.Queue[_QueueItemType]",
+) -> None:
+    while True:
+        item = items.get()
+        transport = transport_ref()
+        if transport is None:
+            return
+
+        try:
+            if not transport._write_batch(item):
+                return
+        except Exception:
+            # The thread must not die, enqueue() and flush() would block forever
+            pass
+
+        # Don't keep the transport alive while waiting for the next record
+        del transport
+
+
+def _stop_sender(items: "queue.Queue[_QueueItemType]") -> None:
+    # When the queue is full the thread notices the transport is gone anyway
+    try:
+        items.put_nowait(None)
+    except queue.Full:
+        pass
+
+
+def _restart_senders_after_fork() -> None:
+    # Only the thread which called fork() exists in the child, so the sender
+    # threads are gone and their queues may hold locks of the parent's threads.
+    for transport in list(_TRANSPORTS):
+        transport._start_sender()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_senders_after_fork)
+
+
 def check_journal_stream() -> bool:
     """ Returns True if journald is listening on stderr otherwise False """
     journal_stream = os.getenv("JOURNAL_STREAM", "")
@@ -144,10 +474,10 @@ def check_journal_stream() -> bool:
     if not journal_stream:
         return False
 
-    st_dev, st_ino = map(int, journal_stream.split(":", 1))
+    st_dev, _, st_ino = journal_stream.partition(":")
     stat = os.stat(sys.stderr.fileno())
 
-    if stat.st_ino == st_ino and stat.st_dev == st_dev:
+    if stat.st_ino == int(st_ino) and stat.st_dev == int(st_dev):
         return True
 
     return False
@@ -187,7 +517,8 @@ class JournaldLogHandler(logging.Handler):
         "threadName": "thread_name",
     })
 
-    __slots__ = ("_facility", "socket", "_identifier")
+    # Everything else in the record's __dict__ is sent as "extra"
+    RECORD_FIELDS = frozenset(RECORD_FIELDS_MAP)
 
     SOCKET_PATH = JournaldTransport.SOCKET_PATH
 
@@ -198,64 +529,90 @@ class JournaldLogHandler(logging.Handler):
         socket_path: Union[str, Path] = SOCKET_PATH,
     ):
         super().__init__()
-        self.transport = JournaldTransport(socket_path=socket_path)
+        self.transport = JournaldTransport(
+            socket_path=socket_path, error_callback=self._on_transport_error,
+        )
         self._identifier = identifier
         self._facility = int(facility)
         self.use_message_id = use_message_id
 
-    @staticmethod
-    def _to_usec(ts: float) -> int:
-        return int(ts * 1000000)
+        # These fields are the same for every record, so they are encoded once
+        self._constant_prefix = JournaldTransport.encode((
+            ("syslog_facility", self._facility),
+            ("syslog_identifier", self._identifier),
+        ))
 
     def _format_record(self, record: logging.LogRecord) -> List[Tuple[str, Any]]:
         message = self.format(record)
+        # LogRecord keeps all the attributes in the instance __dict__,
+        # reading it directly is cheaper than the attribute access.
+        fields = record.__dict__
         message_traceback = ""
-        message_level = self.LEVELS[record.levelno]
+        message_level = self.LEVELS[fields["levelno"]]
         message_facility = self._facility
         message_identifier = self._identifier
-        message_code_string = "{}.{}:{}".format(record.module, record.funcName, record.lineno)
+        message_code_string = "{}.{}:{}".format(fields["module"], fields["funcName"], fields["lineno"])
 
         result = [
             ("message", message),
             ("priority", message_level),
-            ("syslog_facility", message_facility),
-            ("syslog_identifier", message_identifier),
             ("code", message_code_string),
-            ("code", dict(func=record.funcName, file=record.pathname, line=record.lineno, module=record.module)),
-            ("created_usec", self._to_usec(record.created)),
-            ("relative_usec", self._to_usec(record.relativeCreated)),
+            ("code_func", fields["funcName"]),
+            ("code_file", fields["pathname"]),
+            ("code_line", fields["lineno"]),
+            ("code_module", fields["module"]),
+            ("created_usec", int(fields["created"] * 1000000)),
+            ("relative_usec", int(fields["relativeCreated"] * 1000000)),
         ]
 
         message_id = None
 
-        if record.exc_info:
-            exc_type, exc_value, exc_tb = record.exc_info
-            message_traceback = "\n".join(traceback.format_exception(*record.exc_info))
-            result.append(("exception", dict(type=exc_type, value=exc_value)))
+        exc_info = fields["exc_info"]
+        if exc_info:
+            exc_type, exc_value, exc_tb = exc_info
+            message_traceback = "".join(traceback.format_exception(*exc_info))
+            result.append(("exception_type", exc_type))
+            result.append(("exception_value", exc_value))
             result.append(("traceback", message_traceback))
 
         if self.use_message_id:
-            message_hash = "\0".join(
-                map(
-                    str, (
-                        message, traceback, message_level, message_facility,
-                        message_identifier, message_code_string,
-                    ),
-                ),
+            message_hash = "{}\0{}\0{}\0{}\0{}\0{}".format(
+                message, message_traceback, message_level, message_facility,
+                message_identifier, message_code_string,
             )
-            message_id = uuid.uuid3(uuid.NAMESPACE_OID, message_hash).hex
+            message_id = hashlib.blake2b(
+                message_hash.encode(), digest_size=16,
+            ).hexdigest()
             result.append(("message_id", message_id))
 
-        source = dict(record.__dict__)
         for field, name in self.RECORD_FIELDS_MAP.items():
-            value = source.pop(field, None)
-            if name is None or value is None:
+            if name is None:
+                continue
+            value = fields.get(field)
+            if value is None:
                 continue
             result.append((name, value))
 
-        result.append(("extra", source))
+        extra = {
+            key: value for key, value in fields.items()
+            if value is not None and key not in self.RECORD_FIELDS
+        }
+        if extra:
+            result.append(("extra", extra))
         return result
 
+    def flush(self) -> None:
+        self.transport.flush()
+
+    def close(self) -> None:
+        try:
+            self.transport.close()
+        finally:
+            super().close()
+
+    def _on_transport_error(self, record: logging.LogRecord, exc: Exception) -> None:
+        self._fallback(record)
+
     def _fallback(self, record: logging.LogRecord) -> None:
         sys.stderr.write("Unable to write message ")
         sys.stderr.write(repr(self.format(record)))
@@ -263,11 +620,24 @@ class JournaldLogHandler(logging.Handler):
 
     def emit(self, record: logging.LogRecord) -> None:
         try:
-            self.transport.send(self._format_record(record))
+            self.transport.send(
+                self._format_record(record), self._constant_prefix, record,
+            )
         except Exception:
             self._fallback(record)
 
 
+for _key in (
+    "message", "priority", "syslog_facility", "syslog_identifier", "code",
+    "code_func", "code_file", "code_line", "code_module", "created_usec",
+    "relative_usec", "message_id", "exception_type", "exception_value",
+    "traceback", *filter(None, JournaldLogHandler.RECORD_FIELDS_MAP.values()),
+):
+    _key_bytes(_key)
+
+del _key
+
+
 __all__ = (
     "Facility",
     "JournaldLogHandler",
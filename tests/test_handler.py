@@ -1,23 +1,114 @@
+import array
 import asyncio
+import gc
 import logging
 import os
+import queue
 import socket
 import struct
 import sys
-from collections import deque
-from io import BytesIO
+import threading
+import time
+import weakref
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Any, Deque, Mapping, Tuple
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Tuple
 
 import aiomisc
-from aiomisc import bind_socket, threaded
+import pytest
+from aiomisc import bind_socket
 from aiomisc.service import UDPServer
-from pytest_subtests import SubTests
 
+import logging_journald
 from logging_journald import Facility, JournaldLogHandler, JournaldTransport, check_journal_stream
 
 
+_UNPACK_Q = struct.Struct("@Q").unpack_from
+
+REQUIRED_FIELDS = frozenset({
+    "MESSAGE", "MESSAGE_ID", "MESSAGE_RAW", "PRIORITY",
+    "SYSLOG_FACILITY", "CODE", "CODE_FUNC", "CODE_FILE",
+    "CODE_LINE", "CODE_MODULE", "LOGGER_NAME", "PID",
+    "PROCESS_NAME", "THREAD_ID", "THREAD_NAME",
+    "RELATIVE_USEC", "CREATED_USEC",
+})
+
+LogCallType = Tuple[int, Tuple[Any, ...], Dict[str, Any]]
+LogWriterType = Callable[..., List[Mapping[str, Any]]]
+
+
+class LazyDecodeMap(Dict[str, Any]):
+    """ Decodes memoryview values on the first access """
+
+    def __getitem__(self, key: str) -> Any:
+        value = super().__getitem__(key)
+        if isinstance(value, memoryview):
+            value = str(value, "utf-8")
+            self[key] = value
+        return value
+
+
+def parse_datagram(data: bytes) -> LazyDecodeMap:
+    result = LazyDecodeMap()
+    mv = memoryview(data)
+    off = 0
+    while True:
+        nl = data.find(b"\n", off)
+        if nl < 0:
+            break
+
+        start, off = off, nl + 1
+        eq = data.find(b"=", start, nl)
+
+        if eq < 0:
+            key = str(mv[start:nl], "utf-8").strip()
+            value_len = _UNPACK_Q(data, off)[0]
+            off += 8
+            value = mv[off:off + value_len]
+            off += value_len
+            assert data[off:off + 1] == b"\n"
+            off += 1
+        else:
+            # The "=" position is already known, so key and value
+            # are sliced around it, the value is decoded lazily.
+            key = str(mv[start:eq], "utf-8").strip()
+            value = mv[eq + 1:nl]
+
+        result[key] = value
+
+    return result
+
+
+def receive_record(sock: socket.socket) -> LazyDecodeMap:
+    """ Receives one record, records passed as a memfd are read from it """
+    fds = array.array("i")
+    data, ancdata, _, _ = sock.recvmsg(1 << 20, socket.CMSG_SPACE(fds.itemsize))
+    for level, kind, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:fds.itemsize])
+
+    for fd in fds:
+        # The file offset is shared with the sender, so it's at the end
+        with open(fd, "rb") as fp:
+            fp.seek(0)
+            data = fp.read()
+
+    return parse_datagram(data)
+
+
+@pytest.fixture
+def journald_socket(monkeypatch: pytest.MonkeyPatch) -> Iterator[socket.socket]:
+    """ Plain datagram socket which receives records instead of journald """
+    with TemporaryDirectory(dir="/tmp") as tmp_dir:
+        sock_path = Path(tmp_dir) / "journal.sock"
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.bind(str(sock_path))
+            sock.settimeout(5)
+            monkeypatch.setattr(JournaldTransport, "SOCKET_PATH", sock_path)
+            yield sock
+
+
 def test_check_journal_stream() -> None:
     stat = os.stat(sys.stderr.fileno())
     os.environ["JOURNAL_STREAM"] = f"{stat.st_dev}:{stat.st_ino}"
@@ -35,214 +126,411 @@ def test_facility() -> None:
     assert Facility["KERN"] == Facility.KERN
 
 
-def test_journald_logger(  # noqa: C901
-    loop: asyncio.AbstractEventLoop, subtests: SubTests,
-) -> None:
-    with TemporaryDirectory(dir="/tmp") as tmp_dir:
-        tmp_path = Path(tmp_dir)
-        sock_path = tmp_path / "notify.sock"
-
-        logs: Deque[Mapping[str, Any]] = deque()
-
-        class FakeJournald(UDPServer):
-            VALUE_LEN_STRUCT = struct.Struct("@Q")
-
-            async def handle_datagram(
-                self, data: bytes, addr: Tuple[Any, ...],
-            ) -> None:
-                result = {}
-                with BytesIO(data) as fp:
-                    line = fp.readline()
-                    while line:
-                        if b"=" not in line:
-                            key = line.decode().strip()
-                            value_len = self.VALUE_LEN_STRUCT.unpack(
-                                fp.read(
-                                    self.VALUE_LEN_STRUCT.size,
-                                ),
-                            )[0]
-                            value = fp.read(value_len).decode()
-                            assert fp.read(1) == b"\n"
-                        else:
-                            key, value = map(
-                                lambda x: x.strip(),
-                                line.decode().split("=", 1),
-                            )
-
-                        result[key] = value
-                        line = fp.readline()
-
-                logs.append(result)
-
-        @threaded
-        def log_writer() -> None:
-            log = logging.getLogger("test")
-            log.propagate = False
-            log.setLevel(logging.DEBUG)
-            log.handlers.clear()
-            log.handlers.append(JournaldLogHandler())
-
-            log.info("Test message")
-            log.info("Test multiline\nmessage")
-            log.info(
-                "Test formatted: int=%d str=%s repr=%r float=%0.1f",
-                1, 2, 3, 4,
-            )
+@pytest.fixture(scope="module")
+def journald_endpoint() -> Iterator[LogWriterType]:
+    """
+    Starts the fake journald once per module and returns the function which
+    writes log records through JournaldLogHandler and returns them as received.
+    """
+    logs: List[Mapping[str, Any]] = []
 
-            log.info(
-                "Message with extra", extra={
-                    "foo": "bar",
-                },
-            )
+    class FakeJournald(UDPServer):
+        async def handle_datagram(
+            self, data: bytes, addr: Tuple[Any, ...],
+        ) -> None:
+            logs.append(parse_datagram(data))
 
-            log.warning("Warning test message")
-            log.critical("Critical test message")
-            log.error("Error test message")
-            log.log(logging.FATAL, "Fatal test message")
-            log.debug("Debug test message")
+    async def wait_logs(count: int) -> None:
+        while len(logs) < count:
+            await asyncio.sleep(0.001)
 
-            try:
-                1 / 0
-            except ZeroDivisionError:
-                log.exception("Sample exception")
+    with TemporaryDirectory(dir="/tmp") as tmp_dir:
+        sock_path = Path(tmp_dir) / "notify.sock"
 
         with bind_socket(
             socket.AF_UNIX, socket.SOCK_DGRAM, address=str(sock_path),
-        ) as sock:
-            JournaldTransport.SOCKET_PATH = sock_path
-
-            with aiomisc.entrypoint(FakeJournald(sock=sock), loop=loop):
-                loop.run_until_complete(log_writer())
-
-    assert len(logs) == 10
-
-    required_fields = {
-        "MESSAGE", "MESSAGE_ID", "MESSAGE_RAW", "PRIORITY",
-        "SYSLOG_FACILITY", "CODE", "CODE_FUNC", "CODE_FILE",
-        "CODE_LINE", "CODE_MODULE", "LOGGER_NAME", "PID",
-        "PROCESS_NAME", "THREAD_ID", "THREAD_NAME",
-        "RELATIVE_USEC", "CREATED_USEC",
-    }
-
-    with subtests.test("simple message"):
-        message = logs.popleft()
-        assert message["MESSAGE"] == "Test message"
-        assert message["MESSAGE_RAW"] == "Test message"
-        assert message["PRIORITY"] == "6"
-        assert message["CODE_FUNC"] == "log_writer"
-        assert int(message["PID"]) == os.getpid()
-        for field in required_fields:
+        ) as sock, pytest.MonkeyPatch.context() as monkeypatch:
+            # The module scoped fixture can't use the function scoped monkeypatch
+            monkeypatch.setattr(JournaldTransport, "SOCKET_PATH", sock_path)
+
+            with aiomisc.entrypoint(FakeJournald(sock=sock)) as loop:
+                log = logging.getLogger("test")
+                log.propagate = False
+                log.setLevel(logging.DEBUG)
+                log.handlers.clear()
+                handler = JournaldLogHandler()
+                log.handlers.append(handler)
+
+                def log_writer(*calls: LogCallType) -> List[Mapping[str, Any]]:
+                    start = len(logs)
+                    for level, args, kwargs in calls:
+                        log.log(level, *args, **kwargs)
+                    # Records are written by the transport's sender thread
+                    handler.flush()
+                    loop.run_until_complete(
+                        asyncio.wait_for(wait_logs(start + len(calls)), timeout=5),
+                    )
+                    return logs[start:]
+
+                yield log_writer
+
+                log.handlers.remove(handler)
+                handler.close()
+
+
+@pytest.mark.parametrize(
+    "level,args,kwargs,expected", [
+        pytest.param(
+            logging.INFO, ("Test message",), {}, {
+                "MESSAGE": "Test message",
+                "MESSAGE_RAW": "Test message",
+                "PRIORITY": "6",
+            },
+            id="simple message",
+        ),
+        pytest.param(
+            logging.INFO, ("Test multiline\nmessage",), {}, {
+                "MESSAGE": "Test multiline\nmessage",
+                "MESSAGE_RAW": "Test multiline\nmessage",
+                "PRIORITY": "6",
+            },
+            id="multiline message",
+        ),
+        pytest.param(
+            logging.INFO, (
+                "Test formatted: int=%d str=%s repr=%r float=%0.1f",
+                1, 2, 3, 4,
+            ), {}, {
+                "MESSAGE": "Test formatted: int=1 str=2 repr=3 float=4.0",
+                "MESSAGE_RAW": "Test formatted: int=%d str=%s repr=%r float=%0.1f",
+                "ARGUMENTS_0": "1",
+                "ARGUMENTS_1": "2",
+                "ARGUMENTS_2": "3",
+                "ARGUMENTS_3": "4",
+                "PRIORITY": "6",
+            },
+            id="formatted message",
+        ),
+        pytest.param(
+            logging.INFO, ("Message with extra",), {"extra": {"foo": "bar"}}, {
+                "MESSAGE": "Message with extra",
+                "MESSAGE_RAW": "Message with extra",
+                "EXTRA_FOO": "bar",
+                "PRIORITY": "6",
+            },
+            id="message with extra",
+        ),
+        pytest.param(
+            logging.WARNING, ("Warning test message",), {}, {
+                "MESSAGE": "Warning test message",
+                "MESSAGE_RAW": "Warning test message",
+                "PRIORITY": "4",
+            },
+            id="warning message",
+        ),
+        pytest.param(
+            logging.CRITICAL, ("Critical test message",), {}, {
+                "MESSAGE": "Critical test message",
+                "MESSAGE_RAW": "Critical test message",
+                "PRIORITY": "0",
+            },
+            id="critical message",
+        ),
+        pytest.param(
+            logging.ERROR, ("Error test message",), {}, {
+                "MESSAGE": "Error test message",
+                "MESSAGE_RAW": "Error test message",
+                "PRIORITY": "3",
+            },
+            id="error message",
+        ),
+        pytest.param(
+            logging.FATAL, ("Fatal test message",), {}, {
+                "MESSAGE": "Fatal test message",
+                "MESSAGE_RAW": "Fatal test message",
+                "PRIORITY": "0",
+            },
+            id="fatal message",
+        ),
+        pytest.param(
+            logging.DEBUG, ("Debug test message",), {}, {
+                "MESSAGE": "Debug test message",
+                "MESSAGE_RAW": "Debug test message",
+                "PRIORITY": "7",
+            },
+            id="debug message",
+        ),
+    ],
+)
+def test_journald_logger(
+    journald_endpoint: LogWriterType, level: int, args: Tuple[Any, ...],
+    kwargs: Dict[str, Any], expected: Mapping[str, str],
+) -> None:
+    message, = journald_endpoint((level, args, kwargs))
+
+    for field, value in expected.items():
+        assert message[field] == value
+
+    assert message["CODE_FUNC"] == "log_writer"
+    assert int(message["PID"]) == os.getpid()
+
+    for field in REQUIRED_FIELDS:
+        assert field in message
+
+
+def test_journald_logger_many(journald_endpoint: LogWriterType) -> None:
+    # All records are logged before a single flush, so they are batched
+    messages = journald_endpoint(
+        (logging.INFO, ("First message",), {}),
+        (logging.WARNING, ("Second message: %s", "formatted"), {}),
+        (logging.INFO, ("Third message",), {"extra": {"foo": "bar"}}),
+        (logging.ERROR, ("Fourth\nmultiline message",), {}),
+    )
+
+    assert [message["MESSAGE"] for message in messages] == [
+        "First message", "Second message: formatted",
+        "Third message", "Fourth\nmultiline message",
+    ]
+    assert [message["PRIORITY"] for message in messages] == ["6", "4", "6", "3"]
+    assert messages[1]["MESSAGE_RAW"] == "Second message: %s"
+    assert messages[1]["ARGUMENTS_0"] == "formatted"
+    assert messages[2]["EXTRA_FOO"] == "bar"
+
+    for message in messages:
+        for field in REQUIRED_FIELDS:
             assert field in message
 
-    with subtests.test("multiline message"):
-        message = logs.popleft()
-        assert message["MESSAGE"] == "Test multiline\nmessage"
-        assert message["MESSAGE_RAW"] == "Test multiline\nmessage"
-        assert message["PRIORITY"] == "6"
-        assert message["CODE_FUNC"] == "log_writer"
-        assert int(message["PID"]) == os.getpid()
 
-        for field in required_fields:
-            assert field in message
-
-    with subtests.test("formatted message"):
-        message = logs.popleft()
-        assert message["MESSAGE"] == (
-            "Test formatted: int=1 str=2 repr=3 float=4.0"
-        )
-        assert message["MESSAGE_RAW"] == (
-            "Test formatted: int=%d str=%s repr=%r float=%0.1f"
+def test_journald_logger_exception(journald_endpoint: LogWriterType) -> None:
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        message, = journald_endpoint(
+            (logging.ERROR, ("Sample exception",), {"exc_info": True}),
         )
-        assert message["ARGUMENTS_0"] == "1"
-        assert message["ARGUMENTS_1"] == "2"
-        assert message["ARGUMENTS_2"] == "3"
-        assert message["ARGUMENTS_3"] == "4"
-        assert message["PRIORITY"] == "6"
-        assert message["CODE_FUNC"] == "log_writer"
-        assert int(message["PID"]) == os.getpid()
-
-        for field in required_fields:
-            assert field in message
 
-    with subtests.test("message with extra"):
-        message = logs.popleft()
-        assert message["MESSAGE"] == "Message with extra"
-        assert message["MESSAGE_RAW"] == "Message with extra"
-        assert message["PRIORITY"] == "6"
-        assert message["CODE_FUNC"] == "log_writer"
-        assert message["EXTRA_FOO"] == "bar"
-        assert int(message["PID"]) == os.getpid()
+    assert message["MESSAGE"].startswith("Sample exception\nTraceback")
+    assert message["MESSAGE_RAW"] == "Sample exception"
+    assert message["PRIORITY"] == "3"
+    assert message["CODE_FUNC"] == "log_writer"
+    assert int(message["PID"]) == os.getpid()
+    assert message["EXCEPTION_TYPE"] == "<class 'ZeroDivisionError'>"
+    assert message["EXCEPTION_VALUE"] == "division by zero"
+    assert message["TRACEBACK"].startswith(
+        "Traceback (most recent call last)",
+    )
+    assert "\n\n" not in message["TRACEBACK"]
+
+    for field in REQUIRED_FIELDS:
+        assert field in message
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="fork() is not available")
+def test_transport_after_fork(journald_socket: socket.socket) -> None:
+    transport = JournaldTransport()
+
+    pid = os.fork()
+    if pid == 0:
+        # The sender thread must be restarted in the child
+        exit_code = 1
+        try:
+            transport.send([("MESSAGE", "from child"), ("CHILD_PID", os.getpid())])
+            transport.flush()
+            exit_code = 0
+        finally:
+            os._exit(exit_code)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+    message = receive_record(journald_socket)
+    assert message["MESSAGE"] == "from child"
+    assert int(message["CHILD_PID"]) == pid
+
+    transport.send([("MESSAGE", "from parent")])
+    transport.flush()
+    assert receive_record(journald_socket)["MESSAGE"] == "from parent"
+    transport.close()
+
+
+def test_handler_fallback(
+    journald_socket: socket.socket, capsys: pytest.CaptureFixture[str],
+) -> None:
+    log = logging.getLogger("test.fallback")
+    log.propagate = False
+    handler = JournaldLogHandler()
+    log.addHandler(handler)
 
-        for field in required_fields:
-            assert field in message
+    try:
+        # Nobody is listening anymore, so the sender thread fails to write
+        journald_socket.close()
+        log.warning("Important %s", "message")
+        handler.flush()
+    finally:
+        log.removeHandler(handler)
+        handler.close()
 
-    with subtests.test("warning message"):
-        message = logs.popleft()
-        assert message["MESSAGE"] == "Warning test message"
-        assert message["MESSAGE_RAW"] == "Warning test message"
-        assert message["PRIORITY"] == "4"
-        assert message["CODE_FUNC"] == "log_writer"
-        assert int(message["PID"]) == os.getpid()
+    assert (
+        "Unable to write message 'Important message' to journald"
+    ) in capsys.readouterr().err
 
-        for field in required_fields:
-            assert field in message
 
-    with subtests.test("critical message"):
-        message = logs.popleft()
-        assert message["MESSAGE"] == "Critical test message"
-        assert message["MESSAGE_RAW"] == "Critical test message"
-        assert message["PRIORITY"] == "0"
-        assert message["CODE_FUNC"] == "log_writer"
-        assert int(message["PID"]) == os.getpid()
+def test_transport_garbage_collected(journald_socket: socket.socket) -> None:
+    handler = JournaldLogHandler()
+    transport_ref = weakref.ref(handler.transport)
+    thread = handler.transport._thread
 
-        for field in required_fields:
-            assert field in message
+    # The handler is never closed
+    del handler
+    gc.collect()
 
-    with subtests.test("error message"):
-        message = logs.popleft()
-        assert message["MESSAGE"] == "Error test message"
-        assert message["MESSAGE_RAW"] == "Error test message"
-        assert message["PRIORITY"] == "3"
-        assert message["CODE_FUNC"] == "log_writer"
-        assert int(message["PID"]) == os.getpid()
+    assert transport_ref() is None
+    thread.join(5)
+    assert not thread.is_alive()
 
-        for field in required_fields:
-            assert field in message
 
-    with subtests.test("fatal message"):
-        message = logs.popleft()
-        assert message["MESSAGE"] == "Fatal test message"
-        assert message["MESSAGE_RAW"] == "Fatal test message"
-        assert message["PRIORITY"] == "0"
-        assert message["CODE_FUNC"] == "log_writer"
-        assert int(message["PID"]) == os.getpid()
+def test_transport_sender_survives_errors(
+    journald_socket: socket.socket, monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    def error_callback(context: Any, exc: Exception) -> None:
+        raise RuntimeError("error callback failed")
 
-        for field in required_fields:
-            assert field in message
+    class BrokenStream:
+        def write(self, data: str) -> int:
+            raise OSError("stderr is gone")
 
-    with subtests.test("debug message"):
-        message = logs.popleft()
-        assert message["MESSAGE"] == "Debug test message"
-        assert message["MESSAGE_RAW"] == "Debug test message"
-        assert message["PRIORITY"] == "7"
-        assert message["CODE_FUNC"] == "log_writer"
-        assert int(message["PID"]) == os.getpid()
+    transport = JournaldTransport(error_callback=error_callback)
+    submit = transport.submit
 
-        for field in required_fields:
-            assert field in message
+    def submit_or_fail(payload: bytes) -> None:
+        if payload.startswith(b"MESSAGE=fail\n"):
+            raise OSError("write failed")
+        submit(payload)
 
-    with subtests.test("exception message"):
-        message = logs.popleft()
-        assert message["MESSAGE"].startswith("Sample exception\nTraceback")
-        assert message["MESSAGE_RAW"] == "Sample exception"
-        assert message["PRIORITY"] == "3"
-        assert message["CODE_FUNC"] == "log_writer"
-        assert int(message["PID"]) == os.getpid()
-        assert message["EXCEPTION_TYPE"] == "<class 'ZeroDivisionError'>"
-        assert message["EXCEPTION_VALUE"] == "division by zero"
-        assert message["TRACEBACK"].startswith(
-            "Traceback (most recent call last)",
-        )
+    monkeypatch.setattr(transport, "submit", submit_or_fail)
+    monkeypatch.setattr(sys, "stderr", BrokenStream())
 
-        for field in required_fields:
-            assert field in message
+    transport.send([("MESSAGE", "fail")])
+    transport.flush()
+    assert transport._thread.is_alive()
+
+    transport.send([("MESSAGE", "ok")])
+    transport.flush()
+    assert receive_record(journald_socket)["MESSAGE"] == "ok"
+    transport.close()
+
+
+@pytest.fixture
+def stalled_transport(
+    journald_socket: socket.socket, monkeypatch: pytest.MonkeyPatch,
+) -> Iterator[Tuple[JournaldTransport, threading.Event]]:
+    """
+    Returns the transport with a queue of 4 records, whose sender thread took
+    the record "0" and writes nothing until the returned event is set.
+    """
+    monkeypatch.setattr(JournaldTransport, "QUEUE_SIZE", 4)
+    transport = JournaldTransport()
+
+    release = threading.Event()
+    submit_many = transport.submit_many
+
+    def stalled_submit_many(records: Any) -> None:
+        release.wait()
+        submit_many(records)
+
+    monkeypatch.setattr(transport, "submit_many", stalled_submit_many)
+
+    transport.send([("MESSAGE", "0")])
+    while not transport._queue.empty():
+        time.sleep(0.001)
+
+    yield transport, release
+
+    release.set()
+    transport.close()
+
+
+def test_transport_queue_is_bounded(
+    journald_socket: socket.socket,
+    stalled_transport: Tuple[JournaldTransport, threading.Event],
+) -> None:
+    transport, release = stalled_transport
+
+    for idx in range(1, 5):
+        transport.send([("MESSAGE", str(idx))])
+
+    with pytest.raises(queue.Full):
+        transport.send([("MESSAGE", "dropped")], block=False)
+
+    blocked = threading.Thread(target=transport.send, args=([("MESSAGE", "5")],))
+    blocked.start()
+    blocked.join(0.1)
+    assert blocked.is_alive()
+
+    release.set()
+    blocked.join(5)
+    assert not blocked.is_alive()
+    transport.flush()
+
+    for idx in range(6):
+        assert receive_record(journald_socket)["MESSAGE"] == str(idx)
+
+
+@pytest.fixture
+def sendmmsg_calls(monkeypatch: pytest.MonkeyPatch) -> List[Tuple[int, int]]:
+    """ Records (batch size, result) of every sendmmsg call """
+    sendmmsg = logging_journald._sendmmsg
+    if sendmmsg is None:
+        pytest.skip("sendmmsg is not available")
+
+    calls: List[Tuple[int, int]] = []
+
+    def spy(fd: int, payloads: Any) -> int:
+        assert sendmmsg is not None
+        result = sendmmsg(fd, payloads)
+        calls.append((len(payloads), result))
+        return result
+
+    monkeypatch.setattr(logging_journald, "_sendmmsg", spy)
+    return calls
+
+
+def test_transport_sendmmsg_batch(
+    journald_socket: socket.socket, sendmmsg_calls: List[Tuple[int, int]],
+    stalled_transport: Tuple[JournaldTransport, threading.Event],
+) -> None:
+    transport, release = stalled_transport
+
+    # Records queued while the sender thread is busy are written at once
+    for idx in range(1, 5):
+        transport.send([("MESSAGE", str(idx))])
+
+    release.set()
+    transport.flush()
+
+    for idx in range(5):
+        assert receive_record(journald_socket)["MESSAGE"] == str(idx)
+
+    assert sendmmsg_calls == [(4, 4)]
+
+
+def test_transport_sendmmsg_oversized_record(
+    journald_socket: socket.socket, sendmmsg_calls: List[Tuple[int, int]],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(JournaldTransport, "SEND_BUFFER_SIZE", 64 << 10)
+    transport = JournaldTransport()
+
+    big_message = "x" * (1 << 20)
+    messages = ["0", "1", big_message, "3", "4"]
+    transport.submit_many([
+        (transport.encode([("MESSAGE", message)]), None) for message in messages
+    ])
+
+    for message in messages:
+        assert receive_record(journald_socket)["MESSAGE"] == message
+
+    # The batch stops at the oversized record, which is sent via memfd,
+    # then the rest of the batch is retried.
+    assert sendmmsg_calls == [(5, 2), (3, -1), (2, 2)]
+    transport.close()
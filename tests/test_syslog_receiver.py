@@ -0,0 +1,216 @@
+import importlib.util
+import queue
+import socket
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from types import ModuleType
+from typing import Any, Dict, Tuple
+
+import aiomisc
+import pytest
+
+from logging_journald import JournaldTransport
+
+
+EXAMPLE_PATH = Path(__file__).parent.parent / "examples" / "syslog-receiver.py"
+
+
+def load_example() -> ModuleType:
+    spec = importlib.util.spec_from_file_location("syslog_receiver", EXAMPLE_PATH)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+syslog_receiver = load_example()
+
+
+@pytest.fixture
+def syslog_service() -> Any:
+    # Parsing doesn't need the bound socket, so the service isn't initialized
+    return syslog_receiver.SyslogService.__new__(syslog_receiver.SyslogService)
+
+
+@pytest.mark.parametrize(
+    "timestamp,expected", [
+        ("Oct 15 22:14:15", (10, 15, 22, 14, 15)),
+        ("Oct  5 22:14:15", (10, 5, 22, 14, 15)),
+        ("Oct 5 22:14:15", (10, 5, 22, 14, 15)),
+        ("Oct 5 2:14:15", (10, 5, 2, 14, 15)),
+    ],
+)
+def test_parse_timestamp_without_year(
+    syslog_service: Any, timestamp: str, expected: Tuple[int, ...],
+) -> None:
+    result = syslog_service.parse_timestamp(timestamp)
+    assert (result.month, result.day, result.hour, result.minute, result.second) == expected
+    assert result.year == datetime.now().year
+
+
+def test_parse_timestamp_with_year(syslog_service: Any) -> None:
+    result = syslog_service.parse_timestamp("Oct 15 2020 22:14:15")
+    assert result == datetime(2020, 10, 15, 22, 14, 15)
+
+
+@pytest.mark.parametrize(
+    "message,expected", [
+        (
+            "<34>Oct 11 22:14:15 mymachine su: 'su root' failed",
+            {
+                "syslog_priority": "34", "syslog_timestamp": "Oct 11 22:14:15",
+                "syslog_hostname": "mymachine", "syslog_applicaton": "su",
+                "message": "'su root' failed",
+            },
+        ),
+        (
+            "<13>Oct  5 22:14:15 host sshd[123]: hi",
+            {
+                "syslog_priority": "13", "syslog_timestamp": "Oct  5 22:14:15",
+                "syslog_hostname": "host", "syslog_process": "sshd",
+                "syslog_pid": "123", "message": "hi",
+            },
+        ),
+        (
+            "<13>Oct  5 22:14:15 host plain message: without a tag",
+            {
+                "syslog_priority": "13", "syslog_timestamp": "Oct  5 22:14:15",
+                "syslog_hostname": "host", "syslog_applicaton": "plain message",
+                "message": "without a tag",
+            },
+        ),
+        (
+            "<13>Oct  5 22:14:15 host no tag here",
+            {
+                "syslog_priority": "13", "syslog_timestamp": "Oct  5 22:14:15",
+                "syslog_hostname": "host", "message": "no tag here",
+            },
+        ),
+        (
+            "<13>Oct  5 22:14:15 host app[abc]: not a pid",
+            {
+                "syslog_priority": "13", "syslog_timestamp": "Oct  5 22:14:15",
+                "syslog_hostname": "host", "syslog_applicaton": "app[abc]",
+                "message": "not a pid",
+            },
+        ),
+        (
+            "<13>Oct  5 22:14:15 host app[\u00b2]: not an ASCII pid",
+            {
+                "syslog_priority": "13", "syslog_timestamp": "Oct  5 22:14:15",
+                "syslog_hostname": "host", "syslog_applicaton": "app[\u00b2]",
+                "message": "not an ASCII pid",
+            },
+        ),
+    ],
+)
+def test_parse_rfc3164(message: str, expected: Dict[str, str]) -> None:
+    assert syslog_receiver._parse_rfc3164(message) == expected
+
+    # The regex fallback must produce the same fields
+    match = syslog_receiver.SYSLOG_PATTERN.match(message)
+    assert match is not None
+    parsed = {key: value for key, value in match.groupdict().items() if value is not None}
+    assert parsed == expected
+
+
+@pytest.mark.parametrize(
+    "message", [
+        "",
+        "no priority",
+        "<abc>Oct  5 22:14:15 host message",
+        "<13Oct  5 22:14:15 host message",
+        "<13>Oct 5 22:14:15 host message",
+        "<13>Oct  5 22:14:15",
+        "<13>Oct  5 22:14:15 hostname-only",
+        "<13>Foo xx aa:bb:cc host message",
+        "<13>Oct  5 22:1a:15 host message",
+        "<\u00b2>Oct  5 22:14:15 host message",
+        "<13>Oct \u00b2\u00b2 22:14:15 host message",
+    ],
+)
+def test_parse_rfc3164_rejects(message: str) -> None:
+    assert syslog_receiver._parse_rfc3164(message) is None
+
+
+@pytest.mark.parametrize(
+    "message", [
+        "<13>Foo xx aa:bb:cc host message",
+        "<13>Oct  5 22:1a:15 host message",
+        "<\u00b2>Oct  5 22:14:15 host message",
+        "<13>Oct \u00b2\u00b2 22:14:15 host message",
+    ],
+)
+def test_syslog_pattern_rejects(message: str) -> None:
+    # Neither parser accepts these, so parse_message keeps the raw message
+    assert syslog_receiver.SYSLOG_PATTERN.match(message) is None
+
+
+def test_parse_message_unpadded_day_uses_regex(syslog_service: Any) -> None:
+    # The scanner rejects the unpadded day, the regex fallback splits the tag the same way
+    result = syslog_service.parse_message("<13>Oct 5 22:14:15 host sshd[123]: hi")
+    assert result["syslog_process"] == "sshd"
+    assert result["syslog_pid"] == "123"
+    assert "syslog_applicaton" not in result
+    assert result["message"] == "hi"
+    assert result["priority"] == 5
+    assert result["syslog_facility"] == 1
+
+
+@pytest.mark.parametrize("message", ["garbage", "<\u00b2>Oct  5 22:14:15 host message"])
+def test_parse_message_not_syslog(syslog_service: Any, message: str) -> None:
+    result = syslog_service.parse_message(message)
+    assert result == {"syslog_raw": message, "message": message}
+
+
+def test_syslog_service(monkeypatch: pytest.MonkeyPatch) -> None:
+    with TemporaryDirectory(dir="/tmp") as tmp_dir:
+        sock_path = Path(tmp_dir) / "journal.sock"
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as journald:
+            journald.bind(str(sock_path))
+            journald.settimeout(5)
+            monkeypatch.setattr(JournaldTransport, "SOCKET_PATH", sock_path)
+
+            service = syslog_receiver.SyslogService(address="127.0.0.1", port=0)
+            with aiomisc.entrypoint(service, log_config=False) as loop:
+                assert service.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) > 0
+
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+                    client.sendto(
+                        b"<13>Oct  5 22:14:15 host sshd[123]: hi",
+                        ("127.0.0.1", service.port),
+                    )
+
+                # The loop has to run to handle the datagram
+                data = loop.run_until_complete(
+                    loop.run_in_executor(None, journald.recv, 1 << 20),
+                )
+
+    fields = data.split(b"\n")
+    assert b"MESSAGE=hi" in fields
+    assert b"SYSLOG_PROCESS=sshd" in fields
+    assert b"SYSLOG_PID=123" in fields
+
+
+def test_send_log_drops_when_queue_is_full(syslog_service: Any) -> None:
+    full = True
+    sent = []
+
+    class FakeTransport:
+        def send(self, pairs: Any, block: bool = True) -> None:
+            assert not block
+            if full:
+                raise queue.Full
+            sent.append(dict(pairs))
+
+    syslog_service.transport = FakeTransport()
+    syslog_service.send_log(message="first")
+    syslog_service.send_log(message="second")
+    assert syslog_service.dropped == 2
+
+    full = False
+    syslog_service.send_log(message="third")
+    assert syslog_service.dropped == 0
+    assert sent == [{"message": "third"}]